@@ -25,14 +25,36 @@ from tensorflow.contrib.learn.python.learn.estimators import run_config as run_c
 
 
 class TpuConfig(collections.namedtuple(
-    'TpuConfig', ['iterations_per_loop', 'num_shards'])):
-  """TPU related configuration required by `TPUEstimator`."""
+    'TpuConfig', ['iterations_per_loop', 'num_shards', 'check_numerics',
+                  'check_numerics_every_n_loops',
+                  'check_numerics_per_variable'])):
+  """TPU related configuration required by `TPUEstimator`.
 
-  def __new__(cls, iterations_per_loop=2, num_shards=2):
+  If `check_numerics` is True, the trainable variables are checked for NaN and
+  Inf once every `check_numerics_every_n_loops` loops of `iterations_per_loop`
+  steps. The default of 1 checks after each loop; a larger value saves reading
+  the variables on most loops, at the cost of detecting a NaN up to
+  `check_numerics_every_n_loops * iterations_per_loop` steps later.
+
+  By default, the variables of each dtype are checked together by a single op,
+  so the error does not name the offending variable. Set
+  `check_numerics_per_variable` to True to check, and name, each variable
+  separately, e.g. when debugging.
+  """
+
+  def __new__(cls, iterations_per_loop=2, num_shards=2, check_numerics=True,
+              check_numerics_every_n_loops=1,
+              check_numerics_per_variable=False):
+    if check_numerics and check_numerics_every_n_loops < 1:
+      raise ValueError('check_numerics_every_n_loops must be positive, got %d' %
+                       check_numerics_every_n_loops)
     return super(TpuConfig, cls).__new__(
         cls,
         iterations_per_loop=iterations_per_loop,
-        num_shards=num_shards)
+        num_shards=num_shards,
+        check_numerics=check_numerics,
+        check_numerics_every_n_loops=check_numerics_every_n_loops,
+        check_numerics_per_variable=check_numerics_per_variable)
 
 
 class RunConfig(run_config_lib.RunConfig):
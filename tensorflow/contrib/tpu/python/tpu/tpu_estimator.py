@@ -19,8 +19,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import os
 import threading
-from six.moves import queue as Queue  # pylint: disable=redefined-builtin
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensorflow.contrib.tpu.python.tpu import tpu
 from tensorflow.contrib.tpu.python.tpu import tpu_config
@@ -30,10 +32,13 @@ from tensorflow.contrib.tpu.python.tpu import training_loop
 from tensorflow.python.estimator import estimator as estimator_lib
 from tensorflow.python.estimator import model_fn as model_fn_lib
 from tensorflow.python.framework import dtypes
+from tensorflow.python.framework import errors
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import data_flow_ops
 from tensorflow.python.ops import init_ops
+from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import variable_scope
 from tensorflow.python.ops import variables
 from tensorflow.python.platform import tf_logging as logging
@@ -41,18 +46,23 @@ from tensorflow.python.training import session_run_hook
 from tensorflow.python.training import training
 
 
+# Environment variable naming the CPU core the infeed input thread is pinned to.
+_INFEED_CPU_AFFINITY_ENV = 'TF_INFEED_CPU_AFFINITY'
+
+# Time `TpuInfeedSessionHook.end` waits for the input thread to exit.
+_INFEED_JOIN_TIMEOUT_SECS = 30
+
+# Interval, in loops of `iterations_per_loop` steps (i.e. `Session.run` calls),
+# of the infeed logging in `TpuInfeedSessionHook.before_run`.
+_LOG_EVERY_N_LOOPS = 100
+
+
 def _tpu_job(run_config):
   # The tpu job is determined by the run_config. Right now, this method is
   # required as tpu_config is not part of the RunConfig.
   return None if run_config.master in ['', 'local'] else 'tpu_worker'
 
 
-class _SIGNAL(object):
-  """Signal used to control the input thread of infeed."""
-  NEXT_BATCH = 1
-  STOP = 2
-
-
 class InfeedThreadController(object):
   """This wraps the infeed thread and stops when Estimator train finishes.
 
@@ -63,45 +73,130 @@ class InfeedThreadController(object):
   This controller (with coordination with `TpuInfeedSessionHook`) does the
   following:
 
-  1) It pre-infeeds one `batch` data for current TPU iterations.
-
-  2) When `before_run` of `TpuInfeedSessionHook` is called, one more `batch`
-  data will be infed.
+  1) When `before_run` of `TpuInfeedSessionHook` is called, one `batch` data
+  for the TPU iterations of that run will be infed.
 
-  3) When `end` of `TpuInfeedSessionHook` is called, the thread will end
-  gracefully.
+  2) When `end` of `TpuInfeedSessionHook` is called, the thread will end
+  gracefully. It stops between two enqueues, and is abandoned (it is a daemon
+  thread) if an enqueue is still blocked after a timeout, as nothing will
+  dequeue once training has ended.
 
   So, we might need to adjust the algorithrm here if the IO is slower than the
   computation.
+
+  Note that the enqueue loop cannot simply be moved into the graph (e.g., by
+  wrapping the enqueue ops in a `while_loop`). The `features` and `labels`
+  returned by `input_fn` are created outside of any loop, so a `while_loop`
+  would capture them once per `Session.run` and enqueue the same batch for all
+  iterations. Each iteration needs its own `Session.run` until `input_fn` can
+  be invoked inside the enqueue loop.
   """
 
-  def __init__(self, session, enqueue_ops, iterations):
-    self._signal_queue = Queue.Queue()
+  def __init__(self, session, enqueue_op, iterations):
+    # Number of batches requested but not yet picked up by the input thread.
+    # Guarded by `_signal_cv`.
+    self._pending_batches = 0
+    self._stopped = False
+    self._signal_cv = threading.Condition()
+    # The callable parses the fetches once, instead of on every enqueue.
+    self._enqueue_callable = session.make_callable(enqueue_op)
     self._input_thd = threading.Thread(target=self._input_thread_fn_for_loading,
-                                       args=(session, enqueue_ops, iterations))
+                                       args=(iterations,))
     self._input_thd.daemon = True
     self._input_thd.start()
 
-  def _input_thread_fn_for_loading(self, session, enqueue_ops, iterations):
+  def _input_thread_fn_for_loading(self, iterations):
+    self._pin_input_thread()
+    # Checked once, as even a disabled logging.debug call is not free.
+    log_debug = logging.get_verbosity() <= logging.DEBUG
+    # Local bindings avoid attribute lookups in the loop.
+    wait_for_next_batch = self._wait_for_next_batch
+    enqueue = self._enqueue_callable
     count = 0
     while True:
-      signal = self._signal_queue.get()
-      if signal == _SIGNAL.STOP:
+      if not wait_for_next_batch():
         logging.info('Stop Infeed input thread.')
         return
 
-      for i in range(iterations):
-        logging.debug('InfeedEnqueue data for iteration (%d, %d)', count, i)
-        session.run(enqueue_ops)
+      for i in xrange(iterations):
+        if self._stopped:
+          logging.info('Stop Infeed input thread.')
+          return
+        if log_debug:
+          logging.debug('InfeedEnqueue data for iteration (%d, %d)', count, i)
+        try:
+          enqueue()
+        except errors.OpError:
+          # A pending enqueue fails once the TPU system is shut down.
+          if self._stopped:
+            logging.info('Stop Infeed input thread.')
+            return
+          raise
       count += 1
 
+  def _pin_input_thread(self):
+    """Pins the calling thread to the core in `TF_INFEED_CPU_AFFINITY`.
+
+    This keeps the thread from migrating across cores (and NUMA nodes) on busy
+    hosts. The thread priority is raised too, if permitted. Only supported on
+    Linux; a no-op if the environment variable is not set.
+    """
+    cpu_id = os.environ.get(_INFEED_CPU_AFFINITY_ENV)
+    if cpu_id is None:
+      return
+    if not hasattr(os, 'sched_setaffinity'):
+      logging.warning('%s is not supported on this platform.',
+                      _INFEED_CPU_AFFINITY_ENV)
+      return
+    # A bad value must not kill the thread, or the TPU would wait on infeed
+    # forever. On Linux, pid 0 refers to the calling thread only.
+    try:
+      os.sched_setaffinity(0, {int(cpu_id)})
+    except (ValueError, OSError) as e:
+      logging.warning('Cannot pin infeed input thread to CPU %r from %s: %s. '
+                      'Continuing unpinned.', cpu_id, _INFEED_CPU_AFFINITY_ENV,
+                      e)
+      return
+    logging.info('Pinned infeed input thread to CPU %s.', cpu_id)
+    try:
+      os.nice(-5)
+    except OSError:
+      pass
+
+  def _wait_for_next_batch(self):
+    """Blocks until a batch is requested. Returns False if stop is requested.
+
+    Stop takes precedence over pending batches: once training has ended, the
+    TPU will not consume them anymore.
+    """
+    with self._signal_cv:
+      while not self._pending_batches and not self._stopped:
+        self._signal_cv.wait()
+      if self._stopped:
+        return False
+      self._pending_batches -= 1
+      return True
+
   def load_next_batch(self):
-    self._signal_queue.put(_SIGNAL.NEXT_BATCH)
+    with self._signal_cv:
+      self._pending_batches += 1
+      self._signal_cv.notify()
+
+  def join(self, timeout=None):
+    """Stops the input thread and waits for it to exit.
 
-  def join(self):
+    Args:
+      timeout: if not None, the number of seconds to wait for the thread. A
+        thread still blocked in an enqueue after `timeout` is abandoned.
+    """
     logging.info('Waiting for InputThread to exit.')
-    self._signal_queue.put(_SIGNAL.STOP)
-    self._input_thd.join()
+    with self._signal_cv:
+      self._stopped = True
+      self._signal_cv.notify()
+    self._input_thd.join(timeout)
+    if self._input_thd.is_alive():
+      logging.warning('InputThread did not exit within %s secs; abandoning it.',
+                      timeout)
 
 
 class TpuInfeedSessionHook(session_run_hook.SessionRunHook):
@@ -118,29 +213,38 @@ class TpuInfeedSessionHook(session_run_hook.SessionRunHook):
     self._tpu_job = _tpu_job(run_config)
 
   def begin(self):
-    self._enqueue_ops = self._enqueue_fn()
+    self._loop_count = 0
+    self._stage_op, self._enqueue_op = self._enqueue_fn()
     logging.info('TPU job name %s', self._tpu_job)
-    self._init_op = [tpu.initialize_system(job=self._tpu_job)]
-    self._finalize_op = [tpu.shutdown_system(job=self._tpu_job)]
+    self._init_op = tpu.initialize_system(job=self._tpu_job)
+    self._finalize_op = tpu.shutdown_system(job=self._tpu_job)
 
   def after_create_session(self, session, coord):
+    self._init_callable = session.make_callable(self._init_op)
+    self._finalize_callable = session.make_callable(self._finalize_op)
+
     logging.info('Init TPU system')
-    session.run(self._init_op)
+    self._init_callable()
+
+    logging.info('Stage first batch of data for infeed')
+    session.run(self._stage_op)
 
     logging.info('Start infeed input thread controller')
     self._infeed_thd_controller = InfeedThreadController(
-        session, self._enqueue_ops, self._iterations)
+        session, self._enqueue_op, self._iterations)
 
   def before_run(self, run_context):
-    logging.info('Load next batch of data to infeed.')
+    if self._loop_count % _LOG_EVERY_N_LOOPS == 0:
+      logging.info('Load next batch of data to infeed.')
+    self._loop_count += 1
     self._infeed_thd_controller.load_next_batch()
 
   def end(self, session):
     logging.info('Stop infeed input thread controller')
-    self._infeed_thd_controller.join()
+    self._infeed_thd_controller.join(timeout=_INFEED_JOIN_TIMEOUT_SECS)
 
     logging.info('Shutdown TPU system.')
-    session.run(self._finalize_op)
+    self._finalize_callable()
 
 
 class TpuEstimator(estimator_lib.Estimator):
@@ -196,6 +300,90 @@ class TpuEstimator(estimator_lib.Estimator):
                        ops.GraphKeys.GLOBAL_STEP])
 
 
+# Widest rank 2 feature, in elements per example, that `_pack_features` packs.
+# Packing costs a host-side copy of the feature on every enqueue.
+_MAX_PACKED_FEATURE_WIDTH = 32
+
+# A feature packed with others of the same dtype by `_pack_features`. `index`
+# is its position in the unpacked list, `width` its size along the packed
+# dimension and `rank` its original rank.
+_PackedFeature = collections.namedtuple('_PackedFeature',
+                                        ['index', 'width', 'rank'])
+
+
+def _pack_features(features_list, device):
+  """Packs the small features sharing a dtype into a single tensor.
+
+  The whole infeed tuple is sent by one `InfeedEnqueueTuple` op per shard, but
+  each tuple element is still split across the shards by its own op on the
+  host and is a separate buffer in the enqueued and dequeued tuples. Feature
+  dicts with many small tensors thus pay that per-element overhead many times.
+  Rank 1 features, and rank 2 features at most `_MAX_PACKED_FEATURE_WIDTH`
+  wide, with fully defined shapes are concatenated along dimension 1 with the
+  other such features of the same dtype and batch size. Wider features are
+  left alone, as the concatenation copies them on the host for every enqueue.
+  The batch dimension is untouched, so the packed tensors shard as before.
+
+  Args:
+    features_list: list of feature `Tensor`s.
+    device: the host device on which to pack the features.
+
+  Returns:
+    A tuple of (packed_list, layout), where `packed_list` is the list of
+    tensors to infeed. `layout` has an entry for each tensor in `packed_list`:
+    the index of the feature in `features_list` if it is infed as is, or a
+    list of `_PackedFeature` otherwise.
+  """
+  packed_list = []
+  layout = []
+  groups = collections.OrderedDict()
+  for index, tensor in enumerate(features_list):
+    shape = tensor.shape
+    if shape.is_fully_defined() and (
+        shape.ndims == 1 or
+        shape.ndims == 2 and shape[1].value <= _MAX_PACKED_FEATURE_WIDTH):
+      groups.setdefault((tensor.dtype, shape[0].value), []).append(index)
+    else:
+      packed_list.append(tensor)
+      layout.append(index)
+
+  for indices in groups.values():
+    if len(indices) == 1:
+      packed_list.append(features_list[indices[0]])
+      layout.append(indices[0])
+      continue
+    columns = []
+    packed_features = []
+    with ops.device(device):
+      for index in indices:
+        tensor = features_list[index]
+        rank = tensor.shape.ndims
+        if rank == 1:
+          tensor = array_ops.expand_dims(tensor, 1)
+        columns.append(tensor)
+        packed_features.append(
+            _PackedFeature(index, tensor.shape[1].value, rank))
+      packed_list.append(array_ops.concat(columns, axis=1))
+    layout.append(packed_features)
+  return packed_list, layout
+
+
+def _unpack_features(packed_list, layout):
+  """Reverses `_pack_features`, given its returned `layout`."""
+  features_list = [None] * sum(
+      1 if isinstance(entry, int) else len(entry) for entry in layout)
+  for tensor, entry in zip(packed_list, layout):
+    if isinstance(entry, int):
+      features_list[entry] = tensor
+      continue
+    columns = array_ops.split(tensor, [f.width for f in entry], axis=1)
+    for packed_feature, column in zip(entry, columns):
+      if packed_feature.rank == 1:
+        column = array_ops.squeeze(column, axis=[1])
+      features_list[packed_feature.index] = column
+  return features_list
+
+
 # TODO(xiejw): Improve the structure of this input_fn to infeed converion.
 # The code now looks not like Estimator style. We need to abstract many
 # details.
@@ -206,7 +394,7 @@ def _create_infeed_enqueue_ops_and_dequeue_fn(run_config, features, labels):
   1. Calls the input_fn many times (`num_shards`) to infeed the data into TPU
   2. Create a dequeue_fn used by the train_step inside TPU execution to
   dequeue the tensors.
-  3. Sets up the input thread to infeed.
+  3. Sets up the enqueue ops, run by the input thread to infeed.
 
   Args:
     run_config: run_config
@@ -214,16 +402,27 @@ def _create_infeed_enqueue_ops_and_dequeue_fn(run_config, features, labels):
     labels: labels
 
   Returns:
-    A tuple of (dequeue_fn, and thread main function)
+    A tuple of (dequeue_fn, enqueue_fn)
   """
-  infeed_names = None
-  infeed_tuple = []
+  # The host CPU device feeding each shard; each host serves 8 TPU cores.
+  job = _tpu_job(run_config)
+  if job is None:
+    infeed_devices = ('/replica:0/task:0/device:CPU:0',) * (
+        run_config.tpu_config.num_shards)
+  else:
+    infeed_devices = tuple(
+        '/job:%s/replica:0/task:%d/device:CPU:0' % (job, index // 8)
+        for index in range(run_config.tpu_config.num_shards))
+
   if isinstance(features, dict):
-    # We need a fixed ordering for enqueueing and dequeueing.
-    infeed_names = [name for name in features]
-    infeed_tuple.extend([features[name] for name in infeed_names])
+    # We need a fixed ordering for enqueueing and dequeueing. Sorting also
+    # keeps it stable across Python runs.
+    infeed_names = sorted(features)
+    infeed_tuple, infeed_layout = _pack_features(
+        [features[name] for name in infeed_names], infeed_devices[0])
   else:
-    infeed_tuple.append(features)
+    infeed_names = None
+    infeed_tuple = [features]
   # TODO(jhseu): Handle multi-head and None labels
   infeed_tuple.append(labels)
   # TODO(jhseu): Update when b/36470756 is settled.
@@ -238,22 +437,34 @@ def _create_infeed_enqueue_ops_and_dequeue_fn(run_config, features, labels):
     if infeed_names is None:
       return values
     # Restore the feature dictionary and label.
-    dequeued_features = {}
-    for i in range(len(values) - 1):
-      dequeued_features[infeed_names[i]] = values[i]
-    label = values[-1]
-    return dequeued_features, label
+    features_list = _unpack_features(values[:-1], infeed_layout)
+    return dict(zip(infeed_names, features_list)), values[-1]
 
   def enqueue_fn():
-    """enqueue_fn is used to add ops to the graph to send tensors."""
-    job = _tpu_job(run_config)
-    def placement_function(index):
-      if job is None:
-        return '/replica:0/task:0/device:CPU:0'
-      else:
-        return '/job:%s/replica:0/task:%d/device:CPU:0' % (job, index / 8)
-    return infeed_queue.split_inputs_and_generate_enqueue_ops(
-        infeed_tuple, placement_function=placement_function)
+    """enqueue_fn is used to add ops to the graph to send tensors.
+
+    The tensors are sent through a `StagingArea` on the host, so that the next
+    batch is produced by the input pipeline while the current one is infed.
+    The staging area must be primed by running the returned stage op once
+    before any enqueue op is run.
+
+    Returns:
+      A tuple of (stage_op, enqueue_op). `enqueue_op` groups the enqueue ops of
+      all shards and also stages the next batch.
+    """
+    # The tensors may have no device (e.g. when packed), so the staging area is
+    # placed explicitly on the host CPU feeding the first shard.
+    with ops.device(infeed_devices[0]):
+      staging_area = data_flow_ops.StagingArea(
+          dtypes=[t.dtype for t in infeed_tuple],
+          shapes=[t.shape for t in infeed_tuple],
+          capacity=2)
+      stage_op = staging_area.put(infeed_tuple)
+      staged_tuple = staging_area.get()
+
+    enqueue_ops = infeed_queue.split_inputs_and_generate_enqueue_ops(
+        staged_tuple, placement_function=infeed_devices.__getitem__)
+    return stage_op, control_flow_ops.group(*(enqueue_ops + [stage_op]))
 
   return (dequeue_fn, enqueue_fn)
 
@@ -278,44 +489,129 @@ def wrapped_model_fn(model_fn, run_config):
         train_step=_convert_model_fn_to_train_step(
             model_fn, dequeue_fn, mode, run_config))
 
-    # Gets the variables back from TPU nodes. This means the variables updated
-    # by TPU will now be *synced* to host memory.
-    update_ops = [
-        array_ops.check_numerics(v.read_value(),
-                                 'Gradient for %s is NaN' % v.name).op
-        for v in variables.trainable_variables()
-    ]
+    loss, train_op = _build_train_op(loss, run_config)
 
     hooks = [
         TpuInfeedSessionHook(run_config, enqueue_fn),
         training.LoggingTensorHook(
-            {'loss': array_ops.identity(loss),
+            {'loss': loss,
              'step': training.get_global_step()},
             every_n_secs=30)
     ]
 
     return model_fn_lib.EstimatorSpec(
         mode,
-        loss=array_ops.identity(loss),
+        loss=loss,
         training_hooks=hooks,
-        train_op=control_flow_ops.group(*update_ops))
+        train_op=train_op)
   return _model_fn
 
 
+def _build_train_op(loss, run_config):
+  """Returns the host-side loss and train_op for the loss of the TPU loop."""
+  # Gets the variables back from TPU nodes. This means the variables updated
+  # by TPU will now be *synced* to host memory.
+  loss = array_ops.identity(loss, name='tpu_loss')
+  if run_config.tpu_config.check_numerics:
+    tvars = variables.trainable_variables()
+    update_ops = _check_numerics_periodically(
+        loss, tvars, run_config.tpu_config.iterations_per_loop,
+        run_config.tpu_config.check_numerics_every_n_loops,
+        run_config.tpu_config.check_numerics_per_variable)
+  else:
+    update_ops = []
+
+  # Hangs the update ops on the loss directly rather than adding a group
+  # node to fan them in.
+  with ops.control_dependencies(update_ops):
+    train_op = array_ops.identity(loss, name='train_op_sync').op
+  return loss, train_op
+
+
+def _check_numerics_fused(var_list):
+  """Checks the values of `var_list` for NaN and Inf.
+
+  The variables are flattened and concatenated per dtype, so a single
+  `CheckNumerics` op is run for each dtype rather than one for each variable.
+  The cost is that the error message no longer names the offending variable.
+
+  Args:
+    var_list: list of variables to check.
+
+  Returns:
+    A list of ops, one for each dtype in `var_list`.
+  """
+  values_by_dtype = collections.OrderedDict()
+  for v in var_list:
+    value = v.read_value()
+    values_by_dtype.setdefault(value.dtype.base_dtype, []).append(
+        array_ops.reshape(value, [-1]))
+  return [
+      array_ops.check_numerics(array_ops.concat(values, axis=0),
+                               'Gradient for %s variables is NaN' %
+                               dtype.name).op
+      for dtype, values in values_by_dtype.items()
+  ]
+
+
+def _check_numerics_per_variable(var_list):
+  """Checks each variable of `var_list` for NaN and Inf with its own op."""
+  return [
+      array_ops.check_numerics(v.read_value(),
+                               'Gradient for %s is NaN' % v.name).op
+      for v in var_list
+  ]
+
+
+def _check_numerics_periodically(loss, var_list, iterations_per_loop,
+                                 every_n_loops, per_variable):
+  """Checks `var_list` for NaN and Inf once every `every_n_loops` loops.
+
+  The check reads every variable. Unless it runs after each loop, the loops
+  in between skip it in a `cond`. The global step and the variables are read
+  after `loss`, i.e. once the loop that updates them has run.
+
+  Args:
+    loss: the loss of the training loop.
+    var_list: list of variables to check.
+    iterations_per_loop: number of train steps run by each loop.
+    every_n_loops: number of loops between two checks.
+    per_variable: whether to check each variable with its own op, rather than
+      with `_check_numerics_fused`.
+
+  Returns:
+    A list of ops running the check when due.
+  """
+  check_fn = (_check_numerics_per_variable if per_variable
+              else _check_numerics_fused)
+  with ops.control_dependencies([loss]):
+    if every_n_loops == 1:
+      return check_fn(var_list)
+    step = training.get_global_step().read_value()
+    loops = math_ops.floordiv(step, iterations_per_loop)
+    is_due = math_ops.equal(math_ops.mod(loops, every_n_loops), 0)
+    return [control_flow_ops.cond(
+        is_due,
+        lambda: control_flow_ops.group(*check_fn(var_list)),
+        control_flow_ops.no_op).op]
+
+
 def _convert_model_fn_to_train_step(model_fn, dequeue_fn, mode, run_config):
   """generates a train step based on the model_fn."""
 
+  # The model_fn signature is inspected once, not on every train_step call.
+  model_fn_args = estimator_lib._model_fn_args(model_fn)  # pylint: disable=protected-access
+  kwargs = {}
+  if 'mode' in model_fn_args:
+    kwargs['mode'] = mode
+  # Uncomment the following lines once `params` is supported.
+  #   if 'params' in model_fn_args:
+  #     kwargs['params'] = params
+  if 'config' in model_fn_args:
+    kwargs['config'] = run_config
+
   def _call_model_fn(features, labels):
     """Calls the model_fn with required parameters."""
-    model_fn_args = estimator_lib._model_fn_args(model_fn)  # pylint: disable=protected-access
-    kwargs = {}
-    if 'mode' in model_fn_args:
-      kwargs['mode'] = mode
-    # Uncomment the following lines once `params` is supported.
-    #   if 'params' in model_fn_args:
-    #     kwargs['params'] = params
-    if 'config' in model_fn_args:
-      kwargs['config'] = run_config
     return model_fn(features=features, labels=labels, **kwargs)
 
   def _verify_estimator_spec(estimator_spec):
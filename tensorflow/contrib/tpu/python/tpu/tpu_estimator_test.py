@@ -0,0 +1,399 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+
+"""Tests for TpuEstimator infeed utilities."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from tensorflow.contrib.tpu.python.tpu import tpu_config
+from tensorflow.contrib.tpu.python.tpu import tpu_estimator
+from tensorflow.contrib.tpu.python.tpu import tpu_feed
+
+from tensorflow.python.framework import constant_op
+from tensorflow.python.framework import dtypes
+from tensorflow.python.framework import errors
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import data_flow_ops
+from tensorflow.python.ops import variable_scope
+from tensorflow.python.ops import variables
+from tensorflow.python.platform import test
+
+# Upper bound on how long the tests wait for the input thread.
+_TIMEOUT_SECS = 10
+
+
+class _FakeSession(object):
+  """Session whose enqueue callable counts calls and may block."""
+
+  def __init__(self, block_enqueue=False):
+    self.enqueue_count = 0
+    self._lock = threading.Lock()
+    self.entered = threading.Event()
+    self.release = threading.Event()
+    if not block_enqueue:
+      self.release.set()
+
+  def make_callable(self, fetches):
+    del fetches  # unused
+    def _enqueue():
+      with self._lock:
+        self.enqueue_count += 1
+      self.entered.set()
+      self.release.wait()
+    return _enqueue
+
+
+def _wait_until(predicate):
+  deadline = time.time() + _TIMEOUT_SECS
+  while not predicate():
+    if time.time() > deadline:
+      raise AssertionError('Timed out waiting for the input thread.')
+    time.sleep(0.01)
+
+
+class InfeedThreadControllerTest(test.TestCase):
+
+  def _join_in_background(self, controller):
+    join_thd = threading.Thread(target=controller.join)
+    join_thd.daemon = True
+    join_thd.start()
+    return join_thd
+
+  def testEnqueuesIterationsPerBatch(self):
+    session = _FakeSession()
+    controller = tpu_estimator.InfeedThreadController(
+        session, enqueue_op=None, iterations=3)
+    for _ in range(4):
+      controller.load_next_batch()
+    _wait_until(lambda: session.enqueue_count == 12)
+    controller.join()
+    self.assertEqual(12, session.enqueue_count)
+
+  def testJoinDropsPendingBatches(self):
+    session = _FakeSession(block_enqueue=True)
+    controller = tpu_estimator.InfeedThreadController(
+        session, enqueue_op=None, iterations=1)
+    for _ in range(3):
+      controller.load_next_batch()
+    self.assertTrue(session.entered.wait(_TIMEOUT_SECS))
+
+    join_thd = self._join_in_background(controller)
+    _wait_until(lambda: controller._stopped)  # pylint: disable=protected-access
+    session.release.set()
+    join_thd.join(_TIMEOUT_SECS)
+    self.assertFalse(join_thd.is_alive())
+    self.assertEqual(1, session.enqueue_count)
+
+  def testBadCpuAffinityDoesNotKillThread(self):
+    session = _FakeSession()
+    with test.mock.patch.dict(
+        os.environ, {tpu_estimator._INFEED_CPU_AFFINITY_ENV: 'not-a-cpu'}):  # pylint: disable=protected-access
+      controller = tpu_estimator.InfeedThreadController(
+          session, enqueue_op=None, iterations=2)
+      controller.load_next_batch()
+      _wait_until(lambda: session.enqueue_count == 2)
+    controller.join()
+
+  def testJoinWithoutPendingBatches(self):
+    session = _FakeSession()
+    controller = tpu_estimator.InfeedThreadController(
+        session, enqueue_op=None, iterations=2)
+    join_thd = self._join_in_background(controller)
+    join_thd.join(_TIMEOUT_SECS)
+    self.assertFalse(join_thd.is_alive())
+    self.assertEqual(0, session.enqueue_count)
+
+
+class TpuInfeedSessionHookTest(test.TestCase):
+
+  def testEndReturnsWhenEnqueueBlocks(self):
+    run_config = tpu_config.RunConfig(
+        tpu_config=tpu_config.TpuConfig(iterations_per_loop=2))
+    hook = tpu_estimator.TpuInfeedSessionHook(run_config, enqueue_fn=None)
+    session = _FakeSession(block_enqueue=True)
+    finalized = threading.Event()
+    # Bypasses begin and after_create_session, which need a TPU system.
+    hook._finalize_callable = finalized.set  # pylint: disable=protected-access
+    controller = tpu_estimator.InfeedThreadController(
+        session, enqueue_op=None, iterations=2)
+    hook._infeed_thd_controller = controller  # pylint: disable=protected-access
+    controller.load_next_batch()
+    self.assertTrue(session.entered.wait(_TIMEOUT_SECS))
+
+    with test.mock.patch.object(tpu_estimator, '_INFEED_JOIN_TIMEOUT_SECS',
+                                0.1):
+      end_thd = threading.Thread(target=hook.end, args=(session,))
+      end_thd.daemon = True
+      end_thd.start()
+      end_thd.join(_TIMEOUT_SECS)
+    self.assertFalse(end_thd.is_alive())
+    self.assertTrue(finalized.is_set())
+    session.release.set()
+
+
+def _make_features():
+  """Returns features covering all the packing cases, keyed by name."""
+  def _const(shape, dtype):
+    size = int(np.prod(shape))
+    return constant_op.constant(
+        np.arange(size).reshape(shape), dtype=dtype)
+  return {
+      # Packed together: int32 rank 1 and rank 2.
+      'a': _const([4], dtypes.int32),
+      'b': _const([4, 3], dtypes.int32),
+      # Packed together: float32 rank 2 and rank 1.
+      'c': _const([4, 2], dtypes.float32),
+      'd': _const([4], dtypes.float32),
+      # Singleton group.
+      'e': _const([4], dtypes.int64),
+      # Not packable: rank 3.
+      'f': _const([4, 2, 2], dtypes.float32),
+      # Not packable: too wide.
+      'g': _const([4, tpu_estimator._MAX_PACKED_FEATURE_WIDTH + 1],  # pylint: disable=protected-access
+                  dtypes.float32),
+  }
+
+
+class _FakeInfeedQueue(object):
+  """InfeedQueue dequeueing `values` without a TPU.
+
+  The enqueue ops are identities over the enqueued tensors, which are kept in
+  `enqueued`.
+  """
+
+  values = None
+  enqueued = None
+
+  def __init__(self, tuple_types, tuple_shapes):
+    del tuple_types, tuple_shapes  # unused
+
+  def set_number_of_shards(self, number_of_shards):
+    del number_of_shards  # unused
+
+  def generate_dequeue_op(self):
+    return list(_FakeInfeedQueue.values)
+
+  def split_inputs_and_generate_enqueue_ops(self, inputs,
+                                            placement_function=None):
+    del placement_function  # unused
+    _FakeInfeedQueue.enqueued = [array_ops.identity(t) for t in inputs]
+    return [t.op for t in _FakeInfeedQueue.enqueued]
+
+
+class PackFeaturesTest(test.TestCase):
+
+  def testRoundTrip(self):
+    with self.test_session() as sess:
+      features = _make_features()
+      names = sorted(features)
+      features_list = [features[name] for name in names]
+      packed_list, layout = tpu_estimator._pack_features(  # pylint: disable=protected-access
+          features_list, '/cpu:0')
+      # The int32 and float32 groups are packed; 'e', 'f' and 'g' are not.
+      self.assertEqual(5, len(packed_list))
+      unpacked_list = tpu_estimator._unpack_features(packed_list, layout)  # pylint: disable=protected-access
+      for feature, unpacked in zip(features_list, unpacked_list):
+        self.assertEqual(feature.dtype, unpacked.dtype)
+        self.assertEqual(feature.shape.as_list(), unpacked.shape.as_list())
+      expected, actual = sess.run((features_list, unpacked_list))
+      for e, a in zip(expected, actual):
+        self.assertAllEqual(e, a)
+
+  def testDequeueFnRestoresFeatureDict(self):
+    with self.test_session() as sess:
+      features = _make_features()
+      labels = constant_op.constant([0, 1, 0, 1])
+      packed_list, _ = tpu_estimator._pack_features(  # pylint: disable=protected-access
+          [features[name] for name in sorted(features)], '/cpu:0')
+      _FakeInfeedQueue.values = packed_list + [labels]
+      run_config = tpu_config.RunConfig(
+          tpu_config=tpu_config.TpuConfig(num_shards=1))
+      with test.mock.patch.object(tpu_feed, 'InfeedQueue', _FakeInfeedQueue):
+        dequeue_fn, _ = tpu_estimator._create_infeed_enqueue_ops_and_dequeue_fn(  # pylint: disable=protected-access
+            run_config, features, labels)
+        dequeued_features, dequeued_labels = dequeue_fn()
+      self.assertEqual(sorted(features), sorted(dequeued_features))
+      expected, actual = sess.run(
+          ((features, labels), (dequeued_features, dequeued_labels)))
+      self.assertAllEqual(expected[1], actual[1])
+      for name in features:
+        self.assertAllEqual(expected[0][name], actual[0][name])
+
+
+class EnqueueFnTest(test.TestCase):
+
+  def _create_enqueue_fn(self, num_batches):
+    """Returns the enqueue_fn for features and labels read from a queue."""
+    queue = data_flow_ops.FIFOQueue(
+        capacity=num_batches, dtypes=[dtypes.int32, dtypes.int32],
+        shapes=[[1], [1]])
+    batches = [[i] for i in range(num_batches)]
+    enqueue_many = queue.enqueue_many((batches, batches))
+    features, labels = queue.dequeue()
+    run_config = tpu_config.RunConfig(
+        tpu_config=tpu_config.TpuConfig(num_shards=1))
+    with test.mock.patch.object(tpu_feed, 'InfeedQueue', _FakeInfeedQueue):
+      _, enqueue_fn = tpu_estimator._create_infeed_enqueue_ops_and_dequeue_fn(  # pylint: disable=protected-access
+          run_config, {'x': features}, labels)
+      stage_op, enqueue_op = enqueue_fn()
+    return enqueue_many, stage_op, enqueue_op
+
+  def testEnqueuesBatchesInOrder(self):
+    with self.test_session() as sess:
+      enqueue_many, stage_op, enqueue_op = self._create_enqueue_fn(4)
+      sess.run(enqueue_many)
+      sess.run(stage_op)
+      for i in range(3):
+        _, enqueued = sess.run((enqueue_op, _FakeInfeedQueue.enqueued))
+        self.assertAllEqual([[i], [i]], enqueued)
+
+  def testStagingAreaOnInfeedHost(self):
+    with ops.Graph().as_default() as g:
+      self._create_enqueue_fn(1)
+      staging_ops = [op for op in g.get_operations()
+                     if op.type in ('Stage', 'Unstage')]
+      self.assertEqual(2, len(staging_ops))
+      for op in staging_ops:
+        self.assertEqual('/replica:0/task:0/device:CPU:0', op.device)
+
+
+class TpuConfigTest(test.TestCase):
+
+  def testRejectsNonPositiveCheckInterval(self):
+    with self.assertRaisesRegexp(ValueError, 'must be positive'):
+      tpu_config.TpuConfig(check_numerics_every_n_loops=0)
+
+  def testIgnoresCheckIntervalWithoutCheckNumerics(self):
+    config = tpu_config.TpuConfig(check_numerics=False,
+                                  check_numerics_every_n_loops=0)
+    self.assertFalse(config.check_numerics)
+
+
+class BuildTrainOpTest(test.TestCase):
+
+  def testNoCheckWithoutCheckNumerics(self):
+    with ops.Graph().as_default() as g:
+      variable_scope.get_variable(
+          'var', initializer=constant_op.constant([1.]), use_resource=True)
+      loss = constant_op.constant(0.)
+      existing_ops = set(g.get_operations())
+      run_config = tpu_config.RunConfig(
+          tpu_config=tpu_config.TpuConfig(check_numerics=False))
+      _, train_op = tpu_estimator._build_train_op(loss, run_config)  # pylint: disable=protected-access
+      self.assertEqual([], train_op.control_inputs)
+      new_op_types = [op.type for op in g.get_operations()
+                      if op not in existing_ops]
+      self.assertNotIn('CheckNumerics', new_op_types)
+      self.assertNotIn('ReadVariableOp', new_op_types)
+
+
+class CheckNumericsTest(test.TestCase):
+
+  def _make_variables(self, nan_in_float64=False):
+    return [
+        variable_scope.get_variable(
+            'var32', initializer=constant_op.constant([[1., 2.], [3., 4.]]),
+            use_resource=True),
+        variable_scope.get_variable(
+            'var64',
+            initializer=constant_op.constant(
+                [5., np.nan if nan_in_float64 else 6.], dtype=dtypes.float64),
+            use_resource=True),
+    ]
+
+  def testFusedNamesDtype(self):
+    with self.test_session() as sess:
+      var_list = self._make_variables(nan_in_float64=True)
+      check_ops = tpu_estimator._check_numerics_fused(var_list)  # pylint: disable=protected-access
+      self.assertEqual(2, len(check_ops))
+      sess.run(variables.global_variables_initializer())
+      with self.assertRaisesOpError('Gradient for float64 variables is NaN'):
+        sess.run(check_ops)
+
+  def testPerVariableNamesVariable(self):
+    with self.test_session() as sess:
+      var_list = self._make_variables(nan_in_float64=True)
+      check_ops = tpu_estimator._check_numerics_per_variable(var_list)  # pylint: disable=protected-access
+      sess.run(variables.global_variables_initializer())
+      with self.assertRaisesOpError('Gradient for var64:0 is NaN'):
+        sess.run(check_ops)
+
+  def testFusedPassesWhenFinite(self):
+    with self.test_session() as sess:
+      var_list = self._make_variables()
+      check_ops = tpu_estimator._check_numerics_fused(var_list)  # pylint: disable=protected-access
+      sess.run(variables.global_variables_initializer())
+      sess.run(check_ops)
+
+  def testFusedEmptyList(self):
+    self.assertEqual([], tpu_estimator._check_numerics_fused([]))  # pylint: disable=protected-access
+
+
+class CheckNumericsPeriodicallyTest(test.TestCase):
+
+  def _run_check(self, step, iterations_per_loop=2, every_n_loops=3):
+    with ops.Graph().as_default() as g, self.test_session(graph=g) as sess:
+      variable_scope.get_variable(
+          ops.GraphKeys.GLOBAL_STEP,
+          initializer=constant_op.constant(step, dtype=dtypes.int64),
+          trainable=False,
+          collections=[ops.GraphKeys.GLOBAL_VARIABLES,
+                       ops.GraphKeys.GLOBAL_STEP],
+          use_resource=True)
+      var = variable_scope.get_variable(
+          'var', initializer=constant_op.constant([1., np.nan]),
+          use_resource=True)
+      loss = constant_op.constant(0.)
+      check_ops = tpu_estimator._check_numerics_periodically(  # pylint: disable=protected-access
+          loss, [var], iterations_per_loop, every_n_loops, per_variable=False)
+      sess.run(variables.global_variables_initializer())
+      sess.run(check_ops)
+
+  def testChecksWhenDue(self):
+    # Step 6 ends loop 3, and 3 % 3 == 0.
+    with self.assertRaises(errors.InvalidArgumentError):
+      self._run_check(step=6)
+
+  def testSkipsWhenNotDue(self):
+    # Steps 2 and 4 end loops 1 and 2.
+    self._run_check(step=2)
+    self._run_check(step=4)
+
+  def testReadsAfterLoss(self):
+    with ops.Graph().as_default() as g:
+      var = variable_scope.get_variable(
+          'var', initializer=constant_op.constant([1.]), use_resource=True)
+      loss = constant_op.constant(0.)
+      existing_ops = set(g.get_operations())
+      tpu_estimator._check_numerics_periodically(  # pylint: disable=protected-access
+          loss, [var], iterations_per_loop=2, every_n_loops=1,
+          per_variable=True)
+      read_ops = [op for op in g.get_operations()
+                  if op.type == 'ReadVariableOp' and op not in existing_ops]
+      self.assertEqual(1, len(read_ops))
+      self.assertIn(loss.op, read_ops[0].control_inputs)
+
+
+if __name__ == '__main__':
+  test.main()